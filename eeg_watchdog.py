@@ -6,15 +6,24 @@ Tracks processed files to avoid reprocessing.
 """
 
 import os
-import time
+import sys
+import queue
 import argparse
+import collections
+import signal
 import subprocess
 import logging
 import csv
-from datetime import datetime
+import shutil
+import threading
+import time
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
 from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+from watchdog.events import PatternMatchingEventHandler
 
 # Configure logging
 logging.basicConfig(
@@ -24,9 +33,26 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Tracking files
+# Tracking files, kept in a hidden state directory under the monitored directory
+# by default so tracker writes don't generate events for EEG files
+STATE_DIR = ".autoclean_state"
 SUCCESS_TRACKER = "processed_files.csv"
 ERROR_TRACKER = "error_files.csv"
+# One processed filename per line, so startup doesn't have to parse the success CSV
+PROCESSED_INDEX = "processed_files.idx"
+# Size and mtime of the success CSV that the index matches; any other CSV
+# state means it was edited outside the watcher and the index is rebuilt
+PROCESSED_INDEX_SIG = "processed_files.idx.sig"
+SUCCESS_FIELDS = ['filename', 'timestamp', 'filepath']
+ERROR_FIELDS = ['filename', 'timestamp', 'filepath', 'error']
+
+# The error tracker is an append-only journal; it is compacted down to one row
+# per file once it grows past this many rows per live entry
+ERROR_COMPACT_RATIO = 4
+ERROR_COMPACT_MIN_ROWS = 64
+
+# Maximum tracker rows the writer thread writes per batch
+TRACKER_BATCH_ROWS = 50
 
 # Host path environment variables
 HOST_INPUT_DIR = os.environ.get('INPUT_DIR', '')
@@ -34,203 +60,814 @@ HOST_OUTPUT_DIR = os.environ.get('OUTPUT_DIR', '')
 HOST_CONFIG_DIR = os.environ.get('CONFIG_DIR', '')
 HOST_AUTOCLEAN_DIR = os.environ.get('AUTOCLEAN_DIR', '')
 
-class EEGFileHandler(FileSystemEventHandler):
-    def __init__(self, monitor_dir, extensions, script_path, task, config_path, output_dir, work_dir):
+# A detected file is only processed once its size and modification time have
+# stayed the same for STABLE_POLLS checks STABLE_INTERVAL seconds apart, so
+# partially copied uploads are not handed to the script
+STABLE_INTERVAL = 2.0
+STABLE_POLLS = 2
+
+# Lines of script stderr kept in memory for logging and the error tracker;
+# the full output goes to a per-file log under <output>/logs
+STDERR_TAIL_LINES = 20
+
+# Seconds a stopped script gets to exit after SIGTERM before it is killed
+SCRIPT_STOP_TIMEOUT = 10
+
+# Events for these paths are dropped by watchdog before reaching the handler:
+# the tracker files, temp files and hidden files such as partial uploads
+IGNORE_PATTERNS = ['*.csv', '*.tmp', '.*', f'*/{STATE_DIR}/*']
+
+# Container mount point of the input directory
+CONTAINER_INPUT_PREFIX = '/data/input/'
+
+# The watcher only does housekeeping, so main() lowers its CPU priority by this
+# much; pool workers undo it so the processing script runs at normal priority
+WATCHER_NICE = 10
+
+
+# The script a pool worker is currently running, so SIGTERM can stop it too
+_current_script = None
+
+
+def _stop_worker(signum, frame):
+    """Stop the running script's process group, then exit the worker."""
+    process = _current_script
+    if process is not None:
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+            deadline = time.monotonic() + SCRIPT_STOP_TIMEOUT
+            while process.poll() is None and time.monotonic() < deadline:
+                time.sleep(0.1)
+            if process.returncode is None:
+                os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    os._exit(128 + signum)
+
+
+def _init_worker(log_level, nice_delta):
+    """Leave Ctrl+C to the main process, stop the script on SIGTERM and match the log level.
+
+    Handlers are installed rather than SIG_IGN, since ignored signals would stay
+    ignored in the script after exec. nice_delta is the priority drop main()
+    applied to the watcher. main() only applies it after checking that it can
+    be undone.
+    """
+    signal.signal(signal.SIGINT, lambda *_: None)
+    signal.signal(signal.SIGTERM, _stop_worker)
+    logging.getLogger().setLevel(log_level)
+    if nice_delta:
+        try:
+            os.nice(-nice_delta)
+        except OSError as e:
+            logger.warning("Could not restore worker priority: %s", e)
+
+
+def _can_restore_priority(delta):
+    """Check in a throwaway process whether a priority drop of delta can be undone.
+
+    Raising priority again needs CAP_SYS_NICE or a permissive RLIMIT_NICE, which
+    containers usually don't have.
+    """
+    probe = f"import os; os.nice({delta}); os.nice(-{delta})"
+    try:
+        return subprocess.run([sys.executable, '-c', probe], capture_output=True).returncode == 0
+    except OSError:
+        return False
+
+
+def run_script(command, log_path, filename):
+    """Run the processing script in a pool worker and return (returncode, stderr_tail).
+
+    Output is streamed to log_path rather than buffered, so memory stays bounded
+    however verbose the script is. stderr lines are also logged as they arrive,
+    and only the last few are kept for the error tracker.
+    """
+    tail = collections.deque(maxlen=STDERR_TAIL_LINES)
+    # Checked once so quiet log levels skip decoding every line
+    log_stderr = logger.isEnabledFor(logging.WARNING)
+    
+    global _current_script
+    with open(log_path, 'wb', buffering=0) as log_file:
+        # Pass along the original environment variables. The script gets its own
+        # session, so Ctrl+C in the terminal leaves it to finish during a graceful
+        # shutdown and the worker can stop its whole process group.
+        process = subprocess.Popen(
+            command,
+            stdout=log_file,
+            stderr=subprocess.PIPE,
+            env=os.environ,
+            start_new_session=True
+        )
+        _current_script = process
+        for line in process.stderr:
+            log_file.write(line)
+            tail.append(line)
+            if log_stderr:
+                logger.warning("Script stderr [%s]: %s", filename, line.decode(errors='replace').rstrip())
+        process.stderr.close()
+        returncode = process.wait()
+        _current_script = None
+    
+    return returncode, b''.join(tail).decode(errors='replace')
+
+
+class RoundRobinQueue:
+    """Bounded queue with one FIFO per key, drained round-robin across keys.
+
+    A slow kind of file only delays files of the same kind; other keys keep
+    getting their turn. Blocking calls wait on condition variables, so an idle
+    consumer does not wake up until something is put or the queue is closed.
+    """
+    
+    def __init__(self, maxsize):
+        self._maxsize = maxsize
+        self._shards = {}
+        self._ready = collections.deque()  # Keys with pending items, in turn order
+        self._size = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+    
+    def put(self, key, item):
+        """Add an item under key, blocking while the queue is full."""
+        with self._not_full:
+            while self._size >= self._maxsize:
+                self._not_full.wait()
+            shard = self._shards.setdefault(key, collections.deque())
+            if not shard:
+                self._ready.append(key)
+            shard.append(item)
+            self._size += 1
+            self._not_empty.notify()
+    
+    def get(self, block=True):
+        """Take the next item round-robin; returns None once closed and drained.
+
+        Raises queue.Empty if block is False and nothing is pending.
+        """
+        with self._not_empty:
+            while not self._size:
+                if self._closed:
+                    return None
+                if not block:
+                    raise queue.Empty
+                self._not_empty.wait()
+            key = self._ready.popleft()
+            shard = self._shards[key]
+            item = shard.popleft()
+            if shard:
+                self._ready.append(key)
+            self._size -= 1
+            self._not_full.notify()
+            return item
+    
+    def close(self):
+        """Let consumers finish the remaining items and then receive None."""
+        with self._not_empty:
+            self._closed = True
+            self._not_empty.notify_all()
+
+
+class EEGFileHandler(PatternMatchingEventHandler):
+    def __init__(self, monitor_dir, extensions, script_path, task, config_path, output_dir, work_dir, max_workers=3,
+                 state_dir=None, nice_delta=0):
         """Initialize the EEG file handler with minimal parameters."""
         self.monitor_dir = monitor_dir
-        self.extensions = [ext.lower() if ext.startswith('.') else f'.{ext.lower()}' for ext in extensions]
+        self.extensions = frozenset(ext.lower() if ext.startswith('.') else f'.{ext.lower()}' for ext in extensions)
+        
+        # Let watchdog filter events by extension so unrelated files never reach Python callbacks
+        patterns = [f'*{ext}' for ext in self.extensions]
+        super().__init__(
+            patterns=patterns,
+            ignore_patterns=[p for p in IGNORE_PATTERNS if p not in patterns],
+            ignore_directories=True
+        )
         self.script_path = script_path
         self.task = task
         self.config_path = config_path
         self.output_dir = output_dir
         self.work_dir = work_dir
         
+        # Convert container paths to host paths if environment variables are available.
+        # Only the data path changes per file, so everything else is resolved here.
+        # Input paths map to host paths by swapping the container mount prefix
+        if HOST_INPUT_DIR:
+            self._host_input_prefix = HOST_INPUT_DIR if HOST_INPUT_DIR.endswith('/') else HOST_INPUT_DIR + '/'
+        else:
+            self._host_input_prefix = None
+        
+        # Convert config path
+        host_config_path = config_path
+        if HOST_CONFIG_DIR and config_path.startswith('/app/configs/'):
+            # Extract just the directory part, not the file
+            host_config_path = HOST_CONFIG_DIR
+            logger.info("Using host config directory: %s", host_config_path)
+        
+        # Convert output path
+        host_output_path = output_dir
+        if HOST_OUTPUT_DIR and output_dir.startswith('/data/output'):
+            host_output_path = HOST_OUTPUT_DIR
+            logger.info("Using host output path: %s", host_output_path)
+        
+        # Arguments that follow -DataPath in every command
+        self._command_tail = [
+            "-Task", task,
+            "-ConfigPath", host_config_path,
+            "-OutputPath", host_output_path,
+            "-WorkDir", HOST_AUTOCLEAN_DIR
+        ]
+        logger.info("Script arguments after -DataPath: %s", ' '.join(self._command_tail))
+        
         # Setup tracking files
-        self.success_tracker_path = os.path.join(monitor_dir, SUCCESS_TRACKER)
-        self.error_tracker_path = os.path.join(monitor_dir, ERROR_TRACKER)
+        self.state_dir = state_dir or os.path.join(monitor_dir, STATE_DIR)
+        os.makedirs(self.state_dir, exist_ok=True)
+        self.success_tracker_path = os.path.join(self.state_dir, SUCCESS_TRACKER)
+        self.error_tracker_path = os.path.join(self.state_dir, ERROR_TRACKER)
+        self.processed_index_path = os.path.join(self.state_dir, PROCESSED_INDEX)
+        self.processed_index_sig_path = os.path.join(self.state_dir, PROCESSED_INDEX_SIG)
+        
+        # Guards the in-memory tracking data
+        self._tracker_lock = threading.Lock()
         
         # Load tracking data
-        self.processed_files = self._load_processed_files()
+        self.processed_files, index_ok = self._load_processed_files()
+        self.error_files, self._error_journal_rows = self._load_error_files()
+        
+        # A single writer thread owns the tracker files, which stay open for the
+        # life of the handler; recording a result only updates memory and queues the row
+        self._success_file, self._success_writer = self._open_tracker(self.success_tracker_path, SUCCESS_FIELDS)
+        self._error_file, self._error_writer = self._open_tracker(self.error_tracker_path, ERROR_FIELDS)
+        # Without a complete index, appending to it would leave a partial one
+        # that the next start trusts; it is rebuilt from the CSV instead
+        self._index_file = open(self.processed_index_path, 'a') if index_ok else None
+        self._sync_index_signature()
+        self._write_q = queue.Queue()
+        self._writer = threading.Thread(target=self._tracker_writer_loop, daemon=True)
+        self._writer.start()
         
         # Ensure output directory exists
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
-            logger.info(f"Created output directory: {output_dir}")
+            logger.info("Created output directory: %s", output_dir)
+        
+        self.log_dir = os.path.join(output_dir, 'logs')
+        os.makedirs(self.log_dir, exist_ok=True)
+        
+        # Scripts run in worker processes so per-file bookkeeping is not serialized
+        # on the observer thread. Spawn rather than fork, since the observer is
+        # already running threads.
+        self._max_workers = max_workers
+        self._nice_delta = nice_delta
+        self._pool = self._new_pool()
+        
+        # Files that are ready wait in a bounded queue; a full queue blocks the
+        # stabilizer instead of growing without limit during event storms. Files are queued
+        # per extension so one slow file type doesn't hold up the others. The
+        # dispatcher only submits when a worker is free, so the pool never
+        # queues work itself.
+        self._queue = RoundRobinQueue(maxsize=max_workers * 4)
+        self._slots = threading.BoundedSemaphore(max_workers)
+        self._batch_size = max_workers
+        
+        # Filenames that are staged, queued or running, so duplicate events for
+        # one file don't launch the script twice
+        self._inflight = set()
+        self._inflight_lock = threading.Lock()
+        
+        # Detected files wait here until they stop changing; maps each path to
+        # [filename, last (size, mtime), unchanged polls]
+        self._staging = {}
+        self._staging_cond = threading.Condition()
+        self._stopping = threading.Event()
+        
+        self._stabilizer = threading.Thread(target=self._stabilizer_loop, daemon=True)
+        self._stabilizer.start()
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, daemon=True)
+        self._dispatcher.start()
+    
+    def _new_pool(self):
+        """Create the worker pool that runs the processing script."""
+        return ProcessPoolExecutor(
+            max_workers=self._max_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(logging.getLogger().getEffectiveLevel(), self._nice_delta)
+        )
     
     def _load_processed_files(self):
-        """Load list of previously processed files."""
+        """Load previously processed filenames; returns (filenames, index_ok).
+
+        Filenames come from the plain-text index kept beside the success tracker.
+        The CSV is only parsed when the index is missing, e.g. on the first run
+        after an upgrade, or doesn't match the CSV's recorded size and mtime,
+        e.g. after a row was deleted by hand to reprocess a file; the index is
+        then rebuilt from it.
+        """
         processed = set()
         
-        if os.path.exists(self.success_tracker_path):
+        if not os.path.exists(self.success_tracker_path):
+            # No tracker (first run or reset), so any leftover index is stale
+            self._remove_index()
+            return processed, True
+        
+        try:
+            with open(self.processed_index_sig_path, 'r') as sig_file:
+                index_fresh = sig_file.read().split() == [str(v) for v in self._success_signature()]
+        except OSError:
+            index_fresh = False
+        
+        if index_fresh:
             try:
-                with open(self.success_tracker_path, 'r', newline='') as csvfile:
-                    reader = csv.DictReader(csvfile)
-                    for row in reader:
-                        if 'filename' in row:
-                            processed.add(row['filename'])
+                with open(self.processed_index_path, 'r') as index_file:
+                    processed.update(index_file.read().splitlines())
+                processed.discard('')
+                return processed, True
             except Exception as e:
-                logger.error(f"Error reading success tracker: {e}")
+                logger.error("Error reading processed index, rebuilding it: %s", e)
+                processed.clear()
         
-        return processed
+        try:
+            with open(self.success_tracker_path, 'r', newline='') as csvfile:
+                # Plain csv.reader avoids building a dict per row; only one column is needed
+                reader = csv.reader(csvfile)
+                header = next(reader, [])
+                if 'filename' in header:
+                    column = header.index('filename')
+                    processed.update(row[column] for row in reader if len(row) > column)
+        except Exception as e:
+            # Keep what was read for this run, but don't persist a partial index
+            logger.error("Error reading success tracker: %s", e)
+            self._remove_index()
+            return processed, False
+        
+        with open(self.processed_index_path, 'w') as index_file:
+            index_file.writelines(f"{filename}\n" for filename in processed)
+        logger.info("Rebuilt processed index with %d files", len(processed))
+        
+        return processed, True
     
-    def _record_success(self, file_path):
-        """Record successfully processed file."""
-        filename = os.path.basename(file_path)
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    def _success_signature(self):
+        """Return the (size, mtime) of the success CSV on disk."""
+        st = os.stat(self.success_tracker_path)
+        return st.st_size, st.st_mtime_ns
+    
+    def _remove_index(self):
+        """Delete the processed index so the next start rebuilds it from the CSV."""
+        for path in (self.processed_index_path, self.processed_index_sig_path):
+            if os.path.exists(path):
+                os.remove(path)
+    
+    def _sync_index_signature(self):
+        """Record the success CSV's current state as the one the index matches."""
+        st = os.fstat(self._success_file.fileno())
+        self._success_sig = (st.st_size, st.st_mtime_ns)
+        if self._index_file:
+            with open(self.processed_index_sig_path, 'w') as sig_file:
+                sig_file.write(f"{st.st_size} {st.st_mtime_ns}\n")
+    
+    def _check_success_tracker(self):
+        """Stop trusting the index if the success CSV was edited since the last write."""
+        try:
+            changed = self._success_signature() != self._success_sig
+        except FileNotFoundError:
+            changed = True
+        if not changed:
+            return
+        
+        logger.warning("%s was changed outside the watcher; the processed index will be rebuilt on the next start",
+                       self.success_tracker_path)
+        if self._index_file:
+            self._index_file.close()
+            self._index_file = None
+        self._remove_index()
+        # Editors may replace the file rather than rewrite it, so write to whatever is there now
+        self._success_file.close()
+        self._success_file, self._success_writer = self._open_tracker(self.success_tracker_path, SUCCESS_FIELDS)
+    
+    def _load_error_files(self):
+        """Load the latest error entry for each file from the error journal."""
+        latest = {}
+        header = []
+        rows = 0
         
-        file_exists = os.path.exists(self.success_tracker_path)
+        if os.path.exists(self.error_tracker_path):
+            try:
+                with open(self.error_tracker_path, 'r', newline='') as csvfile:
+                    # Keep raw rows and only build dicts for the surviving entries
+                    reader = csv.reader(csvfile)
+                    header = next(reader, [])
+                    if 'filename' in header:
+                        column = header.index('filename')
+                        for row in reader:
+                            rows += 1
+                            # Later rows supersede earlier ones for the same file
+                            if len(row) > column and row[column]:
+                                latest[row[column]] = row
+            except Exception as e:
+                logger.error("Error reading error tracker: %s", e)
         
-        with open(self.success_tracker_path, 'a', newline='') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=['filename', 'timestamp', 'filepath'])
+        errors = {
+            filename: dict(zip(header, row))
+            for filename, row in latest.items()
+            if filename not in self.processed_files
+        }
+        return errors, rows
+    
+    @staticmethod
+    def _open_tracker(path, fieldnames):
+        """Open a tracker file for appending, writing the header if it is new."""
+        csvfile = open(path, 'a', newline='')
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        
+        if csvfile.tell() == 0:
+            writer.writeheader()
+            csvfile.flush()
+        
+        return csvfile, writer
+    
+    def _tracker_writer_loop(self):
+        """Write queued tracker rows in batches until the shutdown sentinel arrives."""
+        while True:
+            # Block for one row, then take whatever else is already waiting so
+            # each tracker file is flushed once per batch
+            batch = [self._write_q.get()]
+            while len(batch) < TRACKER_BATCH_ROWS:
+                try:
+                    batch.append(self._write_q.get_nowait())
+                except queue.Empty:
+                    break
             
-            if not file_exists:
-                writer.writeheader()
+            stop = None in batch
+            success_rows = [row for kind, row in filter(None, batch) if kind == 'success']
+            error_rows = [row for kind, row in filter(None, batch) if kind == 'error']
             
-            writer.writerow({
-                'filename': filename,
-                'timestamp': timestamp,
-                'filepath': file_path
-            })
+            try:
+                if success_rows:
+                    self._check_success_tracker()
+                    self._success_writer.writerows(success_rows)
+                    self._success_file.flush()
+                    if self._index_file:
+                        self._index_file.writelines(f"{row['filename']}\n" for row in success_rows)
+                        self._index_file.flush()
+                    self._sync_index_signature()
+                if error_rows:
+                    self._error_writer.writerows(error_rows)
+                    self._error_file.flush()
+                    self._error_journal_rows += len(error_rows)
+                    
+                    with self._tracker_lock:
+                        live_rows = len(self.error_files)
+                        if self._error_journal_rows > max(ERROR_COMPACT_RATIO * live_rows, ERROR_COMPACT_MIN_ROWS):
+                            self._compact_error_tracker()
+            except Exception as e:
+                logger.error("Error writing tracker files: %s", e)
+            
+            if stop:
+                self._success_file.close()
+                self._error_file.close()
+                if self._index_file:
+                    self._index_file.close()
+                return
+    
+    def _compact_error_tracker(self):
+        """Rewrite the error journal with one row per file. Caller holds the tracker lock."""
+        # Write a fresh copy and swap it in, so a crash mid-compaction leaves
+        # the old journal intact
+        tmp_path = self.error_tracker_path + '.tmp'
+        with open(tmp_path, 'w', newline='') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=ERROR_FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(self.error_files.values())
+            csvfile.flush()
+            os.fsync(csvfile.fileno())
+        os.replace(tmp_path, self.error_tracker_path)
         
-        logger.info(f"Recorded successful processing of {filename}")
-        self.processed_files.add(filename)
+        # The open handle still points at the replaced journal
+        self._error_file.close()
+        self._error_file, self._error_writer = self._open_tracker(self.error_tracker_path, ERROR_FIELDS)
+        
+        logger.info("Compacted error tracker from %d to %d rows", self._error_journal_rows, len(self.error_files))
+        self._error_journal_rows = len(self.error_files)
     
-    def _record_error(self, file_path, error_message):
+    def _record_success(self, file_path, filename):
+        """Record successfully processed file."""
+        timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
+        
+        with self._tracker_lock:
+            self.processed_files.add(filename)
+            # Any earlier error row is now stale; it is dropped on the next compaction
+            self.error_files.pop(filename, None)
+        
+        self._write_q.put(('success', {
+            'filename': filename,
+            'timestamp': timestamp,
+            'filepath': file_path
+        }))
+        
+        logger.info("Recorded successful processing of %s", filename)
+    
+    def _record_error(self, file_path, filename, error_message):
         """Record file processing error."""
-        filename = os.path.basename(file_path)
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
         
-        file_exists = os.path.exists(self.error_tracker_path)
+        row = {
+            'filename': filename,
+            'timestamp': timestamp,
+            'filepath': file_path,
+            'error': error_message[:200]  # Limit error message length
+        }
         
-        with open(self.error_tracker_path, 'a', newline='') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=['filename', 'timestamp', 'filepath', 'error'])
-            
-            if not file_exists:
-                writer.writeheader()
-            
-            writer.writerow({
-                'filename': filename,
-                'timestamp': timestamp,
-                'filepath': file_path,
-                'error': error_message[:200]  # Limit error message length
-            })
+        with self._tracker_lock:
+            self.error_files[filename] = row
+        
+        self._write_q.put(('error', row))
         
-        logger.info(f"Recorded error for {filename}")
+        logger.info("Recorded error for %s", filename)
     
     def on_created(self, event):
         """Handle file creation events."""
-        if not event.is_directory:
-            file_path = event.src_path
-            if self._should_process(file_path):
-                logger.info(f"New EEG data file detected: {file_path}")
-                self._process_file(file_path)
-    
-    def _should_process(self, file_path):
-        """Determine if a file should be processed."""
+        file_path = event.src_path
+        filename = os.path.basename(file_path)
+        if self._should_process(file_path, filename):
+            logger.info("New EEG data file detected: %s", file_path)
+            self._enqueue(file_path, filename)
+    
+    def on_moved(self, event):
+        """Handle files renamed into place, e.g. uploads written under a temporary name."""
+        file_path = event.dest_path
+        filename = os.path.basename(file_path)
+        
+        # A staged file moved before it settled: claims are keyed by filename,
+        # so under the same name it keeps its claim and only its path changes
+        with self._staging_cond:
+            entry = self._staging.pop(event.src_path, None)
+            if entry and entry[0] == filename:
+                self._staging[file_path] = [filename, None, 0]
+                logger.info("Staged EEG data file moved to: %s", file_path)
+                return
+        if entry:
+            self._discard_inflight(entry[0])
+        
+        if self._should_process(file_path, filename):
+            logger.info("EEG data file moved into place: %s", file_path)
+            self._enqueue(file_path, filename)
+    
+    def on_modified(self, event):
+        """Restart the stability check for a staged file that is still being written."""
+        self._restart_stability_check(event.src_path)
+    
+    @staticmethod
+    def _file_ext(filename):
+        """Return the lowercased extension including the dot, or '' if there is none."""
+        dot = filename.rfind('.')
+        return filename[dot:].lower() if dot >= 0 else ''
+    
+    def _should_process(self, file_path, filename):
+        """Determine if a file should be processed, and if so claim it."""
         # Check if it has the right extension
-        file_ext = os.path.splitext(file_path)[1].lower()
-        if file_ext not in self.extensions:
+        if self._file_ext(filename) not in self.extensions:
             return False
+        return self._claim(file_path, filename)
+    
+    def _claim(self, file_path, filename):
+        """Claim a file with a monitored extension unless it is processed or in flight.
+
+        The processed and in-flight checks and the claim happen under one lock,
+        so two events for the same file can't both pass. A claimed file must be
+        released with _discard_inflight or _release once it is done.
+        """
+        with self._inflight_lock:
+            # Check if it's already been processed. Successes are recorded before
+            # the claim is released, so this can't miss a file that just finished.
+            processed = filename in self.processed_files
+            duplicate = not processed and filename in self._inflight
+            if not processed and not duplicate:
+                self._inflight.add(filename)
         
-        # Check if it's already been processed
-        filename = os.path.basename(file_path)
-        if filename in self.processed_files:
-            logger.info(f"Skipping already processed file: {file_path}")
+        if processed:
+            logger.info("Skipping already processed file: %s", file_path)
+            return False
+        
+        if duplicate:
+            # A repeat event means the file is still settling, so debounce it
+            self._restart_stability_check(file_path)
+            logger.info("Skipping duplicate event for in-flight file: %s", file_path)
             return False
         
         return True
     
     def process_existing_files(self):
         """Process existing files in the monitored directory."""
-        logger.info(f"Checking for existing files in {self.monitor_dir}")
-        for file in os.listdir(self.monitor_dir):
-            file_path = os.path.join(self.monitor_dir, file)
-            if os.path.isfile(file_path) and self._should_process(file_path):
-                logger.info(f"Found existing EEG data file to process: {file_path}")
-                self._process_file(file_path)
-    
-    def _process_file(self, file_path):
-        """Process an EEG data file using the autoclean script."""
-        try:
-            # Make sure the script is executable
-            if not os.access(self.script_path, os.X_OK):
-                subprocess.run(['chmod', '+x', self.script_path], check=True)
-                logger.info(f"Made script executable: {self.script_path}")
+        logger.info("Checking for existing files in %s", self.monitor_dir)
+        # scandir reuses the file type from the directory listing instead of a stat per entry
+        candidates = {}
+        with os.scandir(self.monitor_dir) as entries:
+            for entry in entries:
+                # Hidden files (partial uploads, macOS ._ files) are ignored, as for live events
+                if entry.name.startswith('.'):
+                    continue
+                if self._file_ext(entry.name) in self.extensions and entry.is_file():
+                    candidates[entry.name] = entry.path
+        
+        # Drop already processed files in one set operation rather than per entry;
+        # _claim checks each remaining file again, so a late success is still caught
+        with self._tracker_lock:
+            pending = candidates.keys() - self.processed_files
+        logger.info("Found %d existing EEG data files, %d already processed",
+                    len(candidates), len(candidates) - len(pending))
+        
+        for filename in sorted(pending):
+            file_path = candidates[filename]
+            if self._claim(file_path, filename):
+                logger.info("Found existing EEG data file to process: %s", file_path)
+                self._enqueue(file_path, filename)
+    
+    def _enqueue(self, file_path, filename):
+        """Stage a claimed file until it has finished being written."""
+        with self._staging_cond:
+            self._staging[file_path] = [filename, None, 0]
+            self._staging_cond.notify()
+    
+    def _restart_stability_check(self, file_path):
+        """Reset the unchanged-poll count of a staged file, if it is still staged."""
+        with self._staging_cond:
+            entry = self._staging.get(file_path)
+            if entry:
+                entry[2] = 0
+    
+    def _stabilizer_loop(self):
+        """Move staged files to the processing queue once they stop changing."""
+        while True:
+            with self._staging_cond:
+                while not self._staging and not self._stopping.is_set():
+                    self._staging_cond.wait()
             
-            # Convert container paths to host paths if environment variables are available
-            host_file_path = file_path
-            host_config_path = self.config_path
-            host_output_path = self.output_dir
+            if self._stopping.wait(STABLE_INTERVAL):
+                return
             
-            # Convert input file path
-            if HOST_INPUT_DIR and file_path.startswith('/data/input/'):
-                rel_path = os.path.relpath(file_path, '/data/input')
-                host_file_path = os.path.join(HOST_INPUT_DIR, rel_path)
-                logger.info(f"Converted container input path {file_path} to host path {host_file_path}")
+            with self._staging_cond:
+                staged = list(self._staging)
             
-            # Convert config path
-            if HOST_CONFIG_DIR and self.config_path.startswith('/app/configs/'):
-                # Extract just the directory part, not the file
-                host_config_path = HOST_CONFIG_DIR
-                logger.info(f"Using host config directory: {host_config_path}")
-            
-            # Convert output path
-            if HOST_OUTPUT_DIR and self.output_dir.startswith('/data/output'):
-                host_output_path = HOST_OUTPUT_DIR
-                logger.info(f"Using host output path: {host_output_path}")
+            for file_path in staged:
+                try:
+                    st = os.stat(file_path)
+                    current = (st.st_size, st.st_mtime_ns)
+                except OSError:
+                    current = None
+                
+                with self._staging_cond:
+                    entry = self._staging.get(file_path)
+                    if entry is None:
+                        # Moved by on_moved since the snapshot was taken
+                        continue
+                    if current is None:
+                        # Removed before it settled
+                        del self._staging[file_path]
+                    elif current == entry[1]:
+                        entry[2] += 1
+                        if entry[2] < STABLE_POLLS:
+                            continue
+                        del self._staging[file_path]
+                    else:
+                        entry[1] = current
+                        entry[2] = 0
+                        continue
+                
+                filename = entry[0]
+                if current is None:
+                    logger.info("File disappeared before it finished writing: %s", file_path)
+                    self._discard_inflight(filename)
+                else:
+                    self._queue.put(self._file_ext(filename), (file_path, filename))
+    
+    def _discard_inflight(self, filename):
+        """Allow new events for a file to be accepted again."""
+        with self._inflight_lock:
+            self._inflight.discard(filename)
+    
+    def _release(self, filename):
+        """Free the worker slot and in-flight entry held by a file."""
+        self._discard_inflight(filename)
+        self._slots.release()
+    
+    def _dispatch_loop(self):
+        """Hand queued files to the worker pool until the queue is closed and drained.
 
-            host_autoclean_path = HOST_AUTOCLEAN_DIR
+        Once shutdown has started, queued files are released instead of started
+        and are picked up by the startup scan of the next run.
+        """
+        while True:
+            # Block for one file, then take whatever else is already waiting so a
+            # burst is handled in one wakeup
+            batch = [self._queue.get()]
+            while len(batch) < self._batch_size:
+                try:
+                    batch.append(self._queue.get(block=False))
+                except queue.Empty:
+                    break
+            
+            for item in batch:
+                if item is None:
+                    return
+                if self._stopping.is_set():
+                    logger.info("Leaving queued file for the next run: %s", item[0])
+                    self._discard_inflight(item[1])
+                    continue
+                self._slots.acquire()
+                if self._stopping.is_set():
+                    logger.info("Leaving queued file for the next run: %s", item[0])
+                    self._release(item[1])
+                    continue
+                self._process_file(*item)
+    
+    def _process_file(self, file_path, filename):
+        """Submit an EEG data file to the worker pool for the autoclean script."""
+        try:
+            # Convert input file path
+            host_file_path = file_path
+            if self._host_input_prefix and file_path.startswith(CONTAINER_INPUT_PREFIX):
+                host_file_path = self._host_input_prefix + file_path[len(CONTAINER_INPUT_PREFIX):]
+                logger.debug("Converted container input path %s to host path %s", file_path, host_file_path)
             
             # Run the autoclean script with host paths
-            command = [
-                self.script_path,
-                "-DataPath", host_file_path,
-                "-Task", self.task,
-                "-ConfigPath", host_config_path,
-                "-OutputPath", host_output_path,
-                "-WorkDir", host_autoclean_path
-            ]
+            command = [self.script_path, "-DataPath", host_file_path, *self._command_tail]
             
-            logger.info(f"Processing file: {file_path}")
-            logger.info(f"Using host paths in command: {' '.join(command)}")
+            logger.info("Processing file: %s", file_path)
+            logger.debug("Using host paths in command: %s", command)
             
-            # Pass along the original environment variables
-            # Don't use check=True so we can capture output even on failure
-            result = subprocess.run(
-                command,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                env=os.environ
-            )
+            log_path = os.path.join(self.log_dir, filename + '.log')
+            try:
+                future = self._pool.submit(run_script, command, log_path, filename)
+            except BrokenProcessPool:
+                # A worker died (e.g. OOM killed) and the pool can't be used again.
+                # Only this thread submits, so it can swap in a new pool. The other
+                # old workers are sent SIGTERM and stop their scripts; wait for them
+                # to exit so no more than max_workers scripts ever run at once.
+                logger.error("Worker pool broke after a worker died; starting a new pool")
+                self._pool.shutdown(wait=True)
+                self._pool = self._new_pool()
+                future = self._pool.submit(run_script, command, log_path, filename)
+            future.add_done_callback(functools.partial(self._on_script_done, file_path, filename, command, log_path))
             
-            # Log the output regardless of success/failure
-            if result.stdout:
-                logger.info(f"Script stdout: {result.stdout}")
-            if result.stderr:
-                logger.warning(f"Script stderr: {result.stderr}")
+        except Exception as e:
+            logger.error("Unexpected error processing file %s: %s", file_path, e)
+            self._record_error(file_path, filename, str(e))
+            self._release(filename)
+    
+    def _on_script_done(self, file_path, filename, command, log_path, future):
+        """Log the script result and update the trackers once a worker finishes."""
+        try:
+            returncode, stderr = future.result()
+            
+            # stderr was already logged line by line by the worker
+            logger.info("Script output for %s written to %s", file_path, log_path)
             
             # Check return code after capturing output
-            if result.returncode != 0:
+            if returncode != 0:
                 raise subprocess.CalledProcessError(
-                    result.returncode, 
+                    returncode, 
                     command, 
-                    output=result.stdout, 
-                    stderr=result.stderr
+                    stderr=stderr
                 )
             
-            logger.info(f"EEG data processing completed successfully for: {file_path}")
-            self._record_success(file_path)
+            logger.info("EEG data processing completed successfully for: %s", file_path)
+            self._record_success(file_path, filename)
             
         except subprocess.CalledProcessError as e:
-            logger.error(f"Error processing file {file_path}: {e}")
-            logger.error(f"Script stdout: {e.output}")
-            logger.error(f"Script stderr: {e.stderr}")
-            self._record_error(file_path, str(e.stderr))
+            # stderr was already logged line by line; point at the full output instead
+            logger.error("Error processing file %s: exit status %d, output in %s", file_path, e.returncode, log_path)
+            # Keep the end of the tail, where the final exception line is
+            self._record_error(file_path, filename, e.stderr[-200:])
+            
+        except BrokenProcessPool as e:
+            logger.error("Worker process died while processing %s: %s", file_path, e)
+            self._record_error(file_path, filename, str(e))
             
         except Exception as e:
-            logger.error(f"Unexpected error processing file {file_path}: {str(e)}")
-            self._record_error(file_path, str(e))
+            logger.error("Unexpected error processing file %s: %s", file_path, e)
+            self._record_error(file_path, filename, str(e))
+        
+        finally:
+            self._release(filename)
+    
+    def shutdown(self):
+        """Wait for running scripts and flush the trackers.
+
+        No new runs are started; staged and queued files are left for the
+        startup scan of the next run.
+        """
+        self._stopping.set()
+        with self._staging_cond:
+            self._staging_cond.notify_all()
+        self._stabilizer.join()
+        
+        self._queue.close()
+        self._dispatcher.join()
+        self._pool.shutdown(wait=True)
+        self._write_q.put(None)
+        self._writer.join()
 
 
 def main():
@@ -243,28 +880,68 @@ def main():
     parser.add_argument('--config', '-c', required=True, help='Config file path')
     parser.add_argument('--output', '-o', required=True, help='Output directory')
     parser.add_argument('--work_dir', '-w', required=True, help='Working directory')
+    parser.add_argument('--max-workers', type=int, default=int(os.environ.get('MAX_WORKERS', 3)),
+                        help='Maximum number of concurrent processing tasks (default: 3)')
     parser.add_argument('--reset-tracking', action='store_true', help='Reset tracking files')
+    parser.add_argument('--state-dir', help=f'Directory for tracking files (default: <dir>/{STATE_DIR})')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='Logging level (default: INFO)')
     
     args = parser.parse_args()
+    if args.max_workers < 1:
+        parser.error('--max-workers must be at least 1')
+    
+    # Resolve the script once; every run uses the same absolute path
+    args.script = os.path.abspath(args.script)
+    if not os.path.isfile(args.script):
+        parser.error(f'--script not found: {args.script}')
+    
+    logging.getLogger().setLevel(args.log_level)
     
     # Log environment variables for debugging
-    logger.info(f"INPUT_DIR: {os.environ.get('INPUT_DIR', '')}")
-    logger.info(f"OUTPUT_DIR: {os.environ.get('OUTPUT_DIR', '')}")
-    logger.info(f"CONFIG_DIR: {os.environ.get('CONFIG_DIR', '')}")
-    logger.info(f"AUTOCLEAN_DIR: {os.environ.get('AUTOCLEAN_DIR', '')}")
+    logger.info("INPUT_DIR: %s", os.environ.get('INPUT_DIR', ''))
+    logger.info("OUTPUT_DIR: %s", os.environ.get('OUTPUT_DIR', ''))
+    logger.info("CONFIG_DIR: %s", os.environ.get('CONFIG_DIR', ''))
+    logger.info("AUTOCLEAN_DIR: %s", os.environ.get('AUTOCLEAN_DIR', ''))
+    
+    # Make sure the script is executable; checked once here rather than per file
+    if not os.access(args.script, os.X_OK):
+        os.chmod(args.script, os.stat(args.script).st_mode | 0o111)
+        logger.info("Made script executable: %s", args.script)
+    
+    # Lower the watcher's own priority before any worker is started, but only
+    # if the workers can raise theirs back; otherwise the script would inherit it
+    nice_delta = 0
+    if hasattr(os, 'nice') and _can_restore_priority(WATCHER_NICE):
+        base = os.nice(0)
+        nice_delta = os.nice(WATCHER_NICE) - base
+        logger.info("Lowered watcher priority by %d", nice_delta)
+    else:
+        logger.info("Keeping watcher at normal priority; workers could not restore theirs")
+    
+    state_dir = args.state_dir or os.path.join(args.dir, STATE_DIR)
+    os.makedirs(state_dir, exist_ok=True)
+    
+    # Move tracking files left in the monitored directory by older versions
+    for tracker in (SUCCESS_TRACKER, ERROR_TRACKER):
+        legacy_path = os.path.join(args.dir, tracker)
+        state_path = os.path.join(state_dir, tracker)
+        if os.path.exists(legacy_path) and not os.path.exists(state_path):
+            shutil.move(legacy_path, state_path)
+            logger.info("Moved tracking file %s to %s", legacy_path, state_path)
     
     # Reset tracking if requested
     if args.reset_tracking:
-        success_tracker = os.path.join(args.dir, SUCCESS_TRACKER)
-        error_tracker = os.path.join(args.dir, ERROR_TRACKER)
+        success_tracker = os.path.join(state_dir, SUCCESS_TRACKER)
+        error_tracker = os.path.join(state_dir, ERROR_TRACKER)
         
         if os.path.exists(success_tracker):
             os.remove(success_tracker)
-            logger.info(f"Reset success tracker: {success_tracker}")
+            logger.info("Reset success tracker: %s", success_tracker)
             
         if os.path.exists(error_tracker):
             os.remove(error_tracker)
-            logger.info(f"Reset error tracker: {error_tracker}")
+            logger.info("Reset error tracker: %s", error_tracker)
     
     # Initialize the handler and observer
     handler = EEGFileHandler(
@@ -274,29 +951,50 @@ def main():
         args.task,
         args.config,
         args.output,
-        args.work_dir
+        args.work_dir,
+        args.max_workers,
+        state_dir,
+        nice_delta
     )
     
     observer = Observer()
     observer.schedule(handler, args.dir, recursive=True)
     observer.start()
     
-    logger.info(f"Started monitoring directory: {args.dir}")
-    logger.info(f"Watching for files with extensions: {', '.join(args.extensions)}")
+    logger.info("Started monitoring directory: %s", args.dir)
+    logger.info("Watching for files with extensions: %s", ', '.join(args.extensions))
+    logger.info("Maximum concurrent processes: %s", args.max_workers)
     
-    try:
-        # Process existing files first
-        handler.process_existing_files()
-        
-        # Keep the script running
-        while True:
-            time.sleep(1)
-            
-    except KeyboardInterrupt:
-        logger.info("Stopping monitoring")
-        observer.stop()
-        
+    # Block until Ctrl+C or a container stop instead of polling. Shutdown waits
+    # for running scripts; a second signal stops them instead.
+    stop = threading.Event()
+    first_signal = []
+    
+    def on_signal(signum, frame):
+        if not stop.is_set():
+            first_signal.append(time.monotonic())
+            stop.set()
+            return
+        # Tools like timeout send the signal to the process and its group, so a
+        # repeat right after the first one is the same request
+        if time.monotonic() - first_signal[0] < 1:
+            return
+        logger.warning("Second stop signal received, stopping running scripts")
+        for worker in multiprocessing.active_children():
+            worker.terminate()
+    
+    signal.signal(signal.SIGINT, on_signal)
+    signal.signal(signal.SIGTERM, on_signal)
+    
+    # Process existing files first
+    handler.process_existing_files()
+    
+    stop.wait()
+    
+    logger.info("Stopping monitoring")
+    observer.stop()
     observer.join()
+    handler.shutdown()
 
 
 if __name__ == "__main__":